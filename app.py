@@ -43,6 +43,7 @@ rules_model = api.model('Rule', {
 @ns.route('/process')
 class EmailProcessor(Resource):
     @ns.expect(rules_model)
+    @ns.param('dry_run', 'Evaluate the rules and report the planned changes without modifying any email', type='boolean', default=False)
     @ns.response(200, 'Emails processed successfully')
     @ns.response(500, 'Internal Server Error')
     @ns.doc(security='basicAuth')
@@ -50,6 +51,7 @@ class EmailProcessor(Resource):
     def post(self):
         """Process emails based on requested rules"""
         request_data = request.json
+        dry_run = request.args.get('dry_run', 'false').lower() in ('true', '1', 'yes')
 
         validate_response = validate_rules(request_data)
         if validate_response.get("status") is False:
@@ -63,9 +65,11 @@ class EmailProcessor(Resource):
                     "message": message
                 }
                 return response, 401
-            result = process_emails(auth_resp,request_data)
+            result = process_emails(auth_resp,request_data,dry_run)
             if result is None:
                 return {'error': "Something went wrong.", 'output': "ERROR"}, 500
+            if dry_run:
+                return {'message': 'Dry run completed, no emails were modified', 'output': result}, 200
             return {'message': 'Emails processed successfully', 'output': result}, 200
         except Exception as e:
             return {'error': str(e), 'output': traceback.format_exc()}, 500
@@ -3,10 +3,9 @@ import bcrypt
 import random
 import string
 import logging
+import tempfile
+import threading
 
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
 from base import fetch_user
 
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
@@ -14,24 +13,38 @@ logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s %(levelname)s: %(message)s',
                     datefmt='%Y-%m-%d %H:%M:%S')
 
+# Serialises token.json reads and refreshes between concurrent requests in this worker
+token_lock = threading.Lock()
+
+def write_token(creds):
+    # Write to a temp file and rename it, so other workers never read a half written token.json
+    token_dir = os.path.dirname(os.path.abspath('token.json'))
+    with tempfile.NamedTemporaryFile('w', dir=token_dir, suffix='.tmp', delete=False) as token:
+        token.write(creds.to_json())
+    os.replace(token.name, 'token.json')
+
 def authenticate_gmail():
     try:
-        creds = None
-        if not os.path.exists('credentials.json'):
-            logging.error("credentials.json not available.")
-            return None
-        if os.path.exists('token.json'):
-            creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    'credentials.json', SCOPES)
-                creds = flow.run_local_server(port=0)
-            with open('token.json', 'w') as token:
-                token.write(creds.to_json())
-        return creds
+        # The Google auth stack is slow to import, so load it on first use
+        from google.auth.transport.requests import Request
+        from google.oauth2.credentials import Credentials
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        with token_lock:
+            creds = None
+            if not os.path.exists('credentials.json'):
+                logging.error("credentials.json not available.")
+                return None
+            if os.path.exists('token.json'):
+                creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+            if not creds or not creds.valid:
+                if creds and creds.expired and creds.refresh_token:
+                    creds.refresh(Request())
+                else:
+                    flow = InstalledAppFlow.from_client_secrets_file(
+                        'credentials.json', SCOPES)
+                    creds = flow.run_local_server(port=0)
+                write_token(creds)
+            return creds
     except Exception:
         return None
     
@@ -1,7 +1,13 @@
 import mysql.connector
+import hashlib
+import json
 import os
+import tempfile
 import traceback
 
+from contextlib import contextmanager
+from search_index import index_emails, invalidate_search_index, fingerprint_changes
+
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -12,6 +18,18 @@ DB_CONFIG = {
     'database': os.getenv('MY_DB_NAME')
 }
 
+# Rows per multi-row INSERT and rows per transaction for the bulk ingest mode
+BULK_CHUNK_SIZE = int(os.getenv('STORE_EMAILS_CHUNK_SIZE', 500))
+BULK_COMMIT_SIZE = int(os.getenv('STORE_EMAILS_COMMIT_SIZE', 5000))
+
+# Seconds a process run waits for another run on the same mailbox to finish
+MAILBOX_LOCK_TIMEOUT = int(os.getenv('MAILBOX_LOCK_TIMEOUT', 300))
+
+BULK_INSERT_QUERY = '''
+        INSERT INTO emails (id, sender, subject, body, date, user_id, content_hash)
+        VALUES {rows}
+        ON DUPLICATE KEY UPDATE sender = VALUES(sender), subject = VALUES(subject), body = VALUES(body), date = VALUES(date), user_id = VALUES(user_id), content_hash = VALUES(content_hash) '''
+
 
 def fetch_emails_from_table(email_id):
     conn = mysql.connector.connect(**DB_CONFIG)
@@ -31,22 +49,204 @@ def fetch_emails_from_table(email_id):
     conn.close()
     return emails
 
-def store_emails(email_data):
+@contextmanager
+def mailbox_lock(email_id, timeout=MAILBOX_LOCK_TIMEOUT):
+    """Hold a MySQL advisory lock on the mailbox, yielding whether it was acquired.
+
+    Runs on the same mailbox wait for each other, across workers and hosts sharing the database.
+    """
+    # GET_LOCK names are limited to 64 characters
+    lock_name = 'gmail_api:process:' + hashlib.sha1(email_id.encode('utf-8')).hexdigest()
+    conn = None
+    acquired = False
+    try:
+        conn = mysql.connector.connect(**DB_CONFIG)
+        cursor = conn.cursor()
+        cursor.execute('SELECT GET_LOCK(%s, %s)', (lock_name, timeout))
+        acquired = cursor.fetchone()[0] == 1
+        yield acquired
+    finally:
+        # Closing the connection also releases the lock if RELEASE_LOCK fails
+        try:
+            if acquired:
+                cursor.execute('SELECT RELEASE_LOCK(%s)', (lock_name,))
+                cursor.fetchone()
+                cursor.close()
+        finally:
+            if conn is not None:
+                conn.close()
+
+def fetch_database_time():
+    conn = mysql.connector.connect(**DB_CONFIG)
+    cursor = conn.cursor()
+    cursor.execute('SELECT NOW(6)')
+    database_time = cursor.fetchone()[0]
+    cursor.close()
+    conn.close()
+    return database_time
+
+def fetch_process_run_result(email_id, rules_hash, finished_after):
+    """Result of the last run of the same rule set on the mailbox if it finished after finished_after, else None."""
+    conn = mysql.connector.connect(**DB_CONFIG)
+    cursor = conn.cursor()
+    query = '''
+        SELECT result FROM process_runs
+        WHERE email_id = %s AND rules_hash = %s AND finished_at >= %s
+    '''
+    cursor.execute(query, (email_id, rules_hash, finished_after))
+    row = cursor.fetchone()
+    cursor.close()
+    conn.close()
+    return json.loads(row[0]) if row else None
+
+def store_process_run_result(email_id, rules_hash, result):
+    conn = mysql.connector.connect(**DB_CONFIG)
+    cursor = conn.cursor()
+    insert_query = '''
+        INSERT INTO process_runs (email_id, rules_hash, finished_at, result)
+        VALUES (%s, %s, NOW(6), %s)
+        ON DUPLICATE KEY UPDATE finished_at = VALUES(finished_at), result = VALUES(result) '''
+    cursor.execute(insert_query, (email_id, rules_hash, json.dumps(result)))
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+def email_content_hash(email):
+    content = '\x1f'.join(str(email[key]) for key in ('from', 'subject', 'body', 'date', 'user_id'))
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def email_row(email):
+    return (
+        email['id'], email['from'], email['subject'], email['body'], email['date'], email['user_id'], email_content_hash(email)
+    )
+
+def fetch_emails_by_ids(email_id, ids, chunk_size=BULK_CHUNK_SIZE):
+    conn = mysql.connector.connect(**DB_CONFIG)
+    cursor = conn.cursor()
+    ids = list(ids)
+    emails = []
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        placeholders = ', '.join(['%s'] * len(chunk))
+        query = f'''
+            SELECT emails.id, sender, subject, body, date, user_id
+            FROM emails
+            JOIN users ON users.id = emails.user_id
+            WHERE users.email_id = %s AND emails.id IN ({placeholders})
+        '''
+        cursor.execute(query, [email_id] + chunk)
+        emails.extend(cursor.fetchall())
+    cursor.close()
+    conn.close()
+    return emails
+
+def fetch_mailbox_fingerprint(email_id):
+    """Return (user_id, email count, fingerprint) of the mailbox, or None if the user does not exist."""
+    conn = mysql.connector.connect(**DB_CONFIG)
+    cursor = conn.cursor()
+    query = '''
+        SELECT users.id, mailbox_fingerprints.email_count, mailbox_fingerprints.fingerprint
+        FROM users
+        LEFT JOIN mailbox_fingerprints ON mailbox_fingerprints.user_id = users.id
+        WHERE users.email_id = %s
+    '''
+    cursor.execute(query, (email_id,))
+    mailbox = cursor.fetchone()
+    cursor.close()
+    conn.close()
+    return mailbox
+
+def apply_fingerprint_changes(cursor, old_rows, new_rows):
+    """Update the mailbox fingerprints in the same transaction as the emails written over old_rows."""
+    changes = fingerprint_changes(old_rows, new_rows)
+    if not changes:
+        return
+    cursor.executemany('''
+        INSERT INTO mailbox_fingerprints (user_id, email_count, fingerprint) VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE email_count = email_count + VALUES(email_count), fingerprint = fingerprint ^ VALUES(fingerprint) ''',
+        [(user_id, change[0], change[1]) for user_id, change in changes.items()])
+
+def fetch_stored_rows(cursor, ids):
+    """Map of id to (user_id, content_hash) of the stored emails, locked until the transaction ends."""
+    placeholders = ', '.join(['%s'] * len(ids))
+    cursor.execute(f'SELECT id, user_id, content_hash FROM emails WHERE id IN ({placeholders}) FOR UPDATE', list(ids))
+    return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+def refresh_mailbox_fingerprints():
+    """Recompute every mailbox fingerprint from the emails table, run it while no sync is writing."""
+    conn = mysql.connector.connect(**DB_CONFIG)
+    cursor = conn.cursor()
+    cursor.execute('SELECT id, user_id, content_hash FROM emails')
+    changes = fingerprint_changes({}, cursor.fetchall())
+    cursor.execute('DELETE FROM mailbox_fingerprints')
+    cursor.executemany('INSERT INTO mailbox_fingerprints (user_id, email_count, fingerprint) VALUES (%s, %s, %s)',
+                       [(user_id, change[0], change[1]) for user_id, change in changes.items()])
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+def fetch_all_emails(chunk_size=BULK_CHUNK_SIZE):
+    """Yield every stored email in chunks of (id, sender, subject, body, date, user_id, content_hash) rows."""
+    conn = mysql.connector.connect(**DB_CONFIG)
+    cursor = conn.cursor()
+    cursor.execute('SELECT id, sender, subject, body, date, user_id, content_hash FROM emails')
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield rows
+    cursor.close()
+    conn.close()
+
+def store_emails(email_data, mode='upsert', chunk_size=BULK_CHUNK_SIZE, commit_size=BULK_COMMIT_SIZE, index=True):
+    """Store the emails in MySQL and keep the search index current.
+
+    Backfills can pass index=False and rebuild the index once afterwards with search_index.py,
+    until then the mailbox fingerprints differ and the rules scan every email.
+    """
+    if mode == 'bulk':
+        result = bulk_store_emails(email_data, chunk_size, commit_size)
+    elif mode == 'load_data':
+        result = load_data_store_emails(email_data)
+    elif mode == 'upsert':
+        result = upsert_store_emails(email_data)
+    else:
+        return {"status":False,"message":f"Invalid store mode: {mode}. Must be one of upsert, bulk or load_data."}
+    if result.get("status") is True:
+        # The bulk modes only index the rows they wrote, unchanged rows are already current
+        stored_ids = result.pop("stored_ids", None)
+        if index:
+            update_search_index([email_row(email) for email in email_data
+                                 if stored_ids is None or email['id'] in stored_ids])
+    return result
+
+def update_search_index(email_rows):
+    if not email_rows:
+        return
+    try:
+        index_emails(email_rows)
+    except Exception:
+        # A stale index would hide matches, so drop it and let the rules fall back to a full scan
+        print("Exception in updating the search index: "+traceback.format_exc())
+        invalidate_search_index()
+
+def upsert_store_emails(email_data):
     try:
         conn = mysql.connector.connect(**DB_CONFIG)
         cursor = conn.cursor()
 
         insert_query = '''
-        INSERT INTO emails (id, sender, subject, body, date, user_id) 
-        VALUES (%s, %s, %s, %s, %s, %s)
-        ON DUPLICATE KEY UPDATE sender = VALUES(sender), subject = VALUES(subject), body = VALUES(body), date = VALUES(date), user_id = VALUES(user_id) '''
-
-        email_values = [
-            (
-                email['id'], email['from'], email['subject'], email['body'], email['date'], email['user_id']
-            ) for email in email_data
-        ]
+        INSERT INTO emails (id, sender, subject, body, date, user_id, content_hash) 
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE sender = VALUES(sender), subject = VALUES(subject), body = VALUES(body), date = VALUES(date), user_id = VALUES(user_id), content_hash = VALUES(content_hash) '''
+
+        # The content hash is written too, so the bulk modes never skip a row upsert changed
+        email_values = [email_row(email) for email in email_data]
+        old_rows = {}
+        for start in range(0, len(email_values), BULK_CHUNK_SIZE):
+            old_rows.update(fetch_stored_rows(cursor, [row[0] for row in email_values[start:start + BULK_CHUNK_SIZE]]))
         cursor.executemany(insert_query, email_values)
+        apply_fingerprint_changes(cursor, old_rows, [(row[0], row[5], row[6]) for row in email_values])
 
         conn.commit()
         cursor.close()
@@ -56,6 +256,116 @@ def store_emails(email_data):
         print("Exception in storing the email data: "+traceback.format_exc())
         return {"status":False,"message":traceback.format_exc()}
 
+def bulk_store_emails(email_data, chunk_size=BULK_CHUNK_SIZE, commit_size=BULK_COMMIT_SIZE):
+    """Store the emails with chunked multi-row inserts, committing every commit_size rows.
+
+    Rows whose stored content hash matches are skipped, so unchanged bodies are not rewritten.
+    """
+    try:
+        conn = mysql.connector.connect(**DB_CONFIG)
+        cursor = conn.cursor()
+        stored_ids = set()
+        skipped = 0
+        pending = 0
+        for start in range(0, len(email_data), chunk_size):
+            chunk = email_data[start:start + chunk_size]
+            old_rows = fetch_stored_rows(cursor, [email['id'] for email in chunk])
+
+            email_values = []
+            for email in chunk:
+                row = email_row(email)
+                if email['id'] in old_rows and old_rows[email['id']][1] == row[-1]:
+                    skipped += 1
+                    continue
+                email_values.append(row)
+            if email_values:
+                rows = ', '.join(['(%s, %s, %s, %s, %s, %s, %s)'] * len(email_values))
+                cursor.execute(BULK_INSERT_QUERY.format(rows=rows), [value for row in email_values for value in row])
+                apply_fingerprint_changes(cursor, old_rows, [(row[0], row[5], row[6]) for row in email_values])
+                stored_ids.update(row[0] for row in email_values)
+                pending += len(email_values)
+            if pending >= commit_size:
+                conn.commit()
+                pending = 0
+
+        conn.commit()
+        cursor.close()
+        conn.close()
+        return {"status":True,"stored":len(stored_ids),"skipped":skipped,"stored_ids":stored_ids}
+    except Exception:
+        print("Exception in bulk storing the email data: "+traceback.format_exc())
+        return {"status":False,"message":traceback.format_exc()}
+
+def escape_infile_value(value):
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+            .replace('\r', '\\r').replace('\0', '\\0'))
+
+def load_data_store_emails(email_data):
+    """Backfill the emails through a staging table loaded with LOAD DATA LOCAL INFILE.
+
+    Needs local_infile enabled on the MySQL server. Only new or changed rows are
+    copied from the staging table into emails.
+    """
+    infile_path = None
+    conn = None
+    try:
+        with tempfile.NamedTemporaryFile('w', suffix='.tsv', encoding='utf-8', newline='', delete=False) as infile:
+            infile_path = infile.name
+            for email in email_data:
+                infile.write('\t'.join(escape_infile_value(value) for value in email_row(email)) + '\n')
+
+        conn = mysql.connector.connect(allow_local_infile=True, **DB_CONFIG)
+        cursor = conn.cursor()
+        cursor.execute('CREATE TEMPORARY TABLE emails_staging LIKE emails')
+        cursor.execute('''
+            LOAD DATA LOCAL INFILE %s INTO TABLE emails_staging CHARACTER SET utf8mb4
+            FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n'
+            (id, sender, subject, body, date, user_id, content_hash)''', (infile_path,))
+        changed_rows = '''
+            SELECT emails_staging.id, emails_staging.sender, emails_staging.subject, emails_staging.body,
+                   emails_staging.date, emails_staging.user_id, emails_staging.content_hash
+            FROM emails_staging
+            LEFT JOIN emails ON emails.id = emails_staging.id
+            WHERE emails.content_hash IS NULL OR emails.content_hash <> emails_staging.content_hash'''
+        cursor.execute('''
+            SELECT emails_staging.id, emails_staging.user_id, emails_staging.content_hash,
+                   emails.id, emails.user_id, emails.content_hash
+            FROM emails_staging
+            LEFT JOIN emails ON emails.id = emails_staging.id
+            WHERE emails.content_hash IS NULL OR emails.content_hash <> emails_staging.content_hash
+            FOR UPDATE''')
+        changed = cursor.fetchall()
+        stored_ids = {row[0] for row in changed}
+        cursor.execute(f'''
+            INSERT INTO emails (id, sender, subject, body, date, user_id, content_hash)
+            SELECT * FROM ({changed_rows}) AS changed
+            ON DUPLICATE KEY UPDATE sender = changed.sender, subject = changed.subject, body = changed.body, date = changed.date, user_id = changed.user_id, content_hash = changed.content_hash ''')
+        apply_fingerprint_changes(cursor, {row[3]: (row[4], row[5]) for row in changed if row[3] is not None},
+                                  [(row[0], row[1], row[2]) for row in changed])
+        conn.commit()
+        return {"status":True,"stored":len(stored_ids),"skipped":len(email_data) - len(stored_ids),"stored_ids":stored_ids}
+    except Exception:
+        print("Exception in loading the email data: "+traceback.format_exc())
+        return {"status":False,"message":traceback.format_exc()}
+    finally:
+        if conn is not None:
+            close_staging_connection(conn)
+        if infile_path and os.path.exists(infile_path):
+            os.remove(infile_path)
+
+def close_staging_connection(conn):
+    # The temporary table goes with the connection, dropping it first frees it even if the close fails
+    try:
+        cursor = conn.cursor()
+        cursor.execute('DROP TEMPORARY TABLE IF EXISTS emails_staging')
+        cursor.close()
+    except Exception:
+        print("Exception in dropping the staging table: "+traceback.format_exc())
+    finally:
+        conn.close()
+
 
 def create_emails_table():
     conn = mysql.connector.connect(**DB_CONFIG)
@@ -66,7 +376,39 @@ def create_emails_table():
                       subject TEXT,
                       body LONGTEXT,
                       date BIGINT,
-                      user_id INT
+                      user_id INT,
+                      content_hash CHAR(64)
+                    )''')
+    # Tables created before content_hash was added
+    cursor.execute('''SELECT COUNT(*) FROM information_schema.columns
+                      WHERE table_schema = DATABASE() AND table_name = 'emails' AND column_name = 'content_hash' ''')
+    if cursor.fetchone()[0] == 0:
+        cursor.execute('ALTER TABLE emails ADD COLUMN content_hash CHAR(64)')
+    # Email count and fingerprint per user, compared with the search index to tell if it is current
+    cursor.execute('''SELECT COUNT(*) FROM information_schema.tables
+                      WHERE table_schema = DATABASE() AND table_name = 'mailbox_fingerprints' ''')
+    fingerprints_exist = cursor.fetchone()[0] > 0
+    cursor.execute('''CREATE TABLE IF NOT EXISTS mailbox_fingerprints (
+                      user_id INT PRIMARY KEY,
+                      email_count INT NOT NULL,
+                      fingerprint BIGINT UNSIGNED NOT NULL
+                    )''')
+    conn.commit()
+    cursor.close()
+    conn.close()
+    if not fingerprints_exist:
+        refresh_mailbox_fingerprints()
+
+def create_process_runs_table():
+    # Last result per mailbox and rule set, shared with identical runs that waited on the mailbox lock
+    conn = mysql.connector.connect(**DB_CONFIG)
+    cursor = conn.cursor()
+    cursor.execute('''CREATE TABLE IF NOT EXISTS process_runs (
+                      email_id VARCHAR(255) NOT NULL,
+                      rules_hash CHAR(64) NOT NULL,
+                      finished_at DATETIME(6) NOT NULL,
+                      result LONGTEXT,
+                      PRIMARY KEY (email_id, rules_hash)
                     )''')
     conn.commit()
     cursor.close()
@@ -0,0 +1,214 @@
+import os
+import sys
+import time
+import logging
+import random
+import tempfile
+import subprocess
+import mysql.connector
+import search_index
+
+from base import (DB_CONFIG, create_emails_table, create_user_table, store_user, store_emails,
+                  fetch_emails_from_table, email_row)
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s: %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+BENCHMARK_ROWS = 5000
+BENCHMARK_USER_ID = 0
+
+# store_emails mode and whether it updates the search index inline. The variants without it
+# are the backfill path, storing everything and rebuilding the index once afterwards
+STORE_VARIANTS = (
+    ('upsert', True),
+    ('bulk', True),
+    ('load_data', True),
+    ('bulk', False),
+    ('load_data', False)
+)
+
+def generate_emails(count, body_size=2000):
+    return [
+        {
+            'id': f'benchmark-{index}',
+            'from': f'sender{index % 50}@example.com',
+            'subject': f'Benchmark subject {index}',
+            'body': f'Benchmark body {index} ' + 'x' * body_size,
+            'date': 1609459200000 + index,
+            'user_id': BENCHMARK_USER_ID
+        } for index in range(count)
+    ]
+
+def delete_benchmark_emails():
+    conn = mysql.connector.connect(**DB_CONFIG)
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM emails WHERE id LIKE 'benchmark-%'")
+    cursor.execute('DELETE FROM mailbox_fingerprints WHERE user_id = %s', (BENCHMARK_USER_ID,))
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+def log_rate(name, count, seconds, result=None):
+    result = result or {}
+    logging.info(f"{name:<28} {count / seconds:>10.0f} rows/sec ({seconds:.3f}s, stored: {result.get('stored', count)}, skipped: {result.get('skipped', 0)})")
+
+def time_store(email_data, mode, index):
+    start = time.perf_counter()
+    result = store_emails(email_data, mode=mode, index=index)
+    seconds = time.perf_counter() - start
+    if result.get("status") is not True:
+        logging.info(f"{mode} failed: {result.get('message')}")
+        return None
+    log_rate(f"{mode}{'' if index else ' (no index)'}", len(email_data), seconds, result)
+    return seconds
+
+def benchmark_store_emails(count=BENCHMARK_ROWS):
+    """Rows/sec of store_emails in each mode on fresh rows and on an unchanged re-sync, search index upkeep included."""
+    create_emails_table()
+    email_data = generate_emails(count)
+    for mode, index in STORE_VARIANTS:
+        delete_benchmark_emails()
+        with tempfile.TemporaryDirectory() as index_dir:
+            search_index.SEARCH_INDEX_PATH = os.path.join(index_dir, 'emails_fts.db')
+            seconds = time_store(email_data, mode, index)
+            if seconds is not None and not index:
+                # The one off rebuild a backfill needs before the index is used again
+                start = time.perf_counter()
+                search_index.index_emails([email_row(email) for email in email_data])
+                log_rate(f"{mode} + index rebuild", count, seconds + time.perf_counter() - start)
+            time_store(email_data, mode, index)
+    delete_benchmark_emails()
+
+STARTUP_SCRIPT = '''
+import time
+start = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+from google.auth.credentials import AnonymousCredentials
+from gmail_service import build_gmail_service
+build_gmail_service(AnonymousCredentials()).users().getProfile(userId='me')
+print(imported - start, time.perf_counter() - start)
+'''
+STARTUP_MODULES = ('app', 'fetch_emails', 'process_emails')
+STARTUP_RUNS = 5
+BUILD_RUNS = 20
+
+def benchmark_startup():
+    """Import time and import-to-first-request time of the app and CLI entry points.
+
+    The first request is a built Gmail getProfile request, it is not sent.
+    """
+    for module in STARTUP_MODULES:
+        import_times = []
+        ready_times = []
+        for _ in range(STARTUP_RUNS):
+            output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT.format(module=module)],
+                                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                                    capture_output=True, text=True, check=True).stdout.split()
+            import_times.append(float(output[-2]))
+            ready_times.append(float(output[-1]))
+        logging.info(f"{module:<16} import: {min(import_times) * 1000:.1f}ms first request: {min(ready_times) * 1000:.1f}ms (best of {STARTUP_RUNS})")
+
+    from google.auth.credentials import AnonymousCredentials
+    from googleapiclient.discovery import build
+    from gmail_service import build_gmail_service
+    creds = AnonymousCredentials()
+    logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.ERROR)
+    for name, build_service in (('discovery.build', lambda: build('gmail', 'v1', credentials=creds)),
+                                ('build_gmail_service', lambda: build_gmail_service(creds))):
+        start = time.perf_counter()
+        for _ in range(BUILD_RUNS):
+            build_service()
+        logging.info(f"{name:<20} {(time.perf_counter() - start) / BUILD_RUNS * 1000:.2f}ms per client")
+
+SEARCH_ROWS = 20000
+# Share of emails containing each rule keyword in the synthetic corpus
+SEARCH_KEYWORD_RATE = 0.05
+SEARCH_RULES = {
+    "predicate": "All",
+    "rules": [{
+        "conditions": [
+            {"field": "subject", "predicate": "contains", "value": "livable"},
+            {"field": "message", "predicate": "contains", "value": "Security"}
+        ],
+        "actions": ["mark_as_read"]
+    }]
+}
+
+SEARCH_EMAIL_ID = 'benchmark-search@example.com'
+
+def delete_search_benchmark_user(user_id):
+    conn = mysql.connector.connect(**DB_CONFIG)
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM emails WHERE user_id = %s', (user_id,))
+    cursor.execute('DELETE FROM mailbox_fingerprints WHERE user_id = %s', (user_id,))
+    cursor.execute('DELETE FROM users WHERE id = %s', (user_id,))
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+def benchmark_search(count=SEARCH_ROWS):
+    """Full table fetch and scan against fingerprint check, search index lookup, candidate fetch and verification."""
+    from process_emails import email_row_to_dict, fetch_candidate_emails, rules_match
+    create_emails_table()
+    create_user_table()
+    random.seed(0)
+    words = [''.join(random.choices('abcdefghijklmnopqrstuvwxyz', k=random.randint(3, 10))) for _ in range(5000)]
+    user_id = store_user(SEARCH_EMAIL_ID, 'benchmark')
+    email_data = generate_emails(count, body_size=0)
+    for email in email_data:
+        subject_words = random.choices(words, k=6)
+        body_words = random.choices(words, k=300)
+        if random.random() < SEARCH_KEYWORD_RATE:
+            subject_words.append('unlivable')
+        if random.random() < SEARCH_KEYWORD_RATE:
+            body_words.append('Security')
+        email['id'] = email['id'].replace('benchmark-', 'benchmark-search-')
+        email['subject'] = ' '.join(subject_words)
+        email['body'] = ' '.join(body_words)
+        email['user_id'] = user_id
+
+    try:
+        with tempfile.TemporaryDirectory() as index_dir:
+            search_index.SEARCH_INDEX_PATH = os.path.join(index_dir, 'emails_fts.db')
+            start = time.perf_counter()
+            result = store_emails(email_data, mode='bulk')
+            if result.get("status") is not True:
+                logging.info(f"Storing the emails failed: {result.get('message')}")
+                return
+            logging.info(f"Stored and indexed {count} emails in {time.perf_counter() - start:.3f}s")
+
+            start = time.perf_counter()
+            rows = fetch_emails_from_table(SEARCH_EMAIL_ID)
+            scan_ids = {row[0] for row in rows if rules_match(email_row_to_dict(row), SEARCH_RULES)}
+            scan_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            candidates, used_search_index, _ = fetch_candidate_emails(SEARCH_EMAIL_ID, SEARCH_RULES)
+            index_ids = {row[0] for row in candidates if rules_match(email_row_to_dict(row), SEARCH_RULES)}
+            index_seconds = time.perf_counter() - start
+    finally:
+        delete_search_benchmark_user(user_id)
+
+    logging.info(f"full scan        {scan_seconds * 1000:.1f}ms ({len(scan_ids)} matches of {len(rows)})")
+    logging.info(f"search index     {index_seconds * 1000:.1f}ms ({len(index_ids)} matches of {len(candidates)} candidates, used: {used_search_index})")
+    logging.info(f"same matches: {scan_ids == index_ids}")
+
+BENCHMARKS = {
+    'store_emails': benchmark_store_emails,
+    'startup': benchmark_startup,
+    'search': benchmark_search
+}
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            logging.info(f"Unknown benchmark: {name}. Must be one of {list(BENCHMARKS)}")
+            continue
+        logging.info(f"Running benchmark: {name}")
+        BENCHMARKS[name]()
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,10 @@
 import base64
 import logging
+import os
 
-from googleapiclient.discovery import build
 from authorise import authenticate_gmail, generate_password, hash_password
-from base import store_emails, create_emails_table, create_user_table, fetch_user, store_user
+from gmail_service import build_gmail_service
+from base import store_emails, create_emails_table, create_user_table, create_process_runs_table, fetch_user, store_user
 
 
 # Configure logging
@@ -48,9 +49,10 @@ def main():
         }
         logging.info(f"Authentication failed: {message}")
         return response
-    service = build('gmail', 'v1', credentials=creds)
+    service = build_gmail_service(creds)
     create_emails_table()
     create_user_table()
+    create_process_runs_table()
     email = service.users().getProfile(userId='me').execute()['emailAddress']
     user_data = fetch_user(email)
     user_id = None
@@ -66,9 +68,11 @@ def main():
         return False
     email_data = fetch_emails(service, user_id)
     if len(email_data) > 0:
-        result = store_emails(email_data)
+        result = store_emails(email_data, mode=os.getenv('STORE_EMAILS_MODE', 'bulk'),
+                              index=os.getenv('STORE_EMAILS_INDEX', 'true').lower() == 'true')
         if result and result.get("status") is True:
             logging.info(f"Stored the email data in table from mail id: {str(email_data[0]['id'])} to mail id: {str(email_data[len(email_data)-1]['id'])}")
+            logging.info(f"Stored: {result.get('stored')} Skipped unchanged: {result.get('skipped')}")
         else:
             logging.info(f"Could not store the email data in table. Error message: {str(result.get('message'))}")
     else:
@@ -0,0 +1,29 @@
+import json
+import marshal
+import os
+import logging
+
+from functools import lru_cache
+
+# Bundled copy of https://gmail.googleapis.com/$discovery/rest?version=v1
+# Refresh it by downloading that url over discovery/gmail.v1.json.
+DISCOVERY_DOCUMENT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'discovery', 'gmail.v1.json')
+
+@lru_cache(maxsize=None)
+def load_discovery_document():
+    """Parse the bundled Gmail discovery document once per process, callers must not modify it."""
+    with open(DISCOVERY_DOCUMENT_PATH, encoding='utf-8') as document:
+        discovery_document = json.load(document)
+    logging.info(f"Loaded Gmail discovery document {discovery_document['version']} revision {discovery_document['revision']}")
+    return discovery_document
+
+@lru_cache(maxsize=None)
+def discovery_document_bytes():
+    # marshal round trips the plain JSON types several times faster than copy.deepcopy
+    return marshal.dumps(load_discovery_document())
+
+def build_gmail_service(creds):
+    # googleapiclient pulls in the whole Google client stack, so import it on first use
+    from googleapiclient.discovery import build_from_document
+    # build_from_document fixes up the method parameters in place, so each build gets its own copy
+    return build_from_document(marshal.loads(discovery_document_bytes()), credentials=creds)
@@ -1,18 +1,45 @@
 import json
-from googleapiclient.discovery import build
+import hashlib
 import logging
 import random
 import traceback
 import sys
 import re
-from base import fetch_emails_from_table
+import time
+import threading
+from base import (fetch_emails_from_table, fetch_emails_by_ids, fetch_mailbox_fingerprint, mailbox_lock,
+                  fetch_database_time, fetch_process_run_result, store_process_run_result)
+from search_index import MIN_SEARCH_LENGTH, SEARCH_COLUMNS, indexed_fingerprint, search_email_ids
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 from authorise import authenticate_gmail
+from gmail_service import build_gmail_service
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
+# Gmail API quota units consumed per method call
+# https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    'users.getProfile': 1,
+    'users.labels.list': 1,
+    'users.messages.modify': 5
+}
+
+# Matched email ids listed in a dry run result, the counts cover every match
+DRY_RUN_MAX_EMAIL_IDS = 20
+
+# Process runs in flight in this worker, keyed by mailbox and rule set
+in_flight_runs = {}
+in_flight_lock = threading.Lock()
+
+# Label change made by each action, as (modify body key, label)
+ACTION_LABEL_CHANGES = {
+    'mark_as_read': ('removeLabelIds', 'UNREAD'),
+    'mark_as_unread': ('addLabelIds', 'UNREAD'),
+    'move_message': ('addLabelIds', '<random user label>')
+}
+
 def apply_rule(email, rule):
     for condition in rule['conditions']:
         field = condition['field']
@@ -49,21 +76,20 @@ def apply_rule(email, rule):
             return False
     return True
 
-def process_rules(auth_resp, email, rules):
+def process_rules(service, email, rules):
     try:
         return_rule_list = []
         for rule in rules['rules']:
             if rules['predicate'] == 'All' and all(apply_rule(email, rule) for rule in rules['rules']):
-                return_rule_list.append(perform_actions(auth_resp, email, rule['actions']))
+                return_rule_list.append(perform_actions(service, email, rule['actions']))
             elif rules['predicate'] == 'Any' and any(apply_rule(email, rule) for rule in rules['rules']):
-                return_rule_list.append(perform_actions(auth_resp, email, rule['actions']))
+                return_rule_list.append(perform_actions(service, email, rule['actions']))
         return return_rule_list
     except Exception:
         logging.error(f"Exception in process rules:  {traceback.format_exc()}")
         return []
 
-def perform_actions(auth_resp, email, actions):
-    service = build('gmail', 'v1', credentials=auth_resp)
+def perform_actions(service, email, actions):
     results = service.users().labels().list(userId='me').execute()
     labels = results.get('labels', [])
     filtered_labels = [label['name'] for label in labels 
@@ -91,24 +117,175 @@ def perform_actions(auth_resp, email, actions):
             logging.info(f"Moved email from: {email['from']} with subject: {email['subject']} to {random_label}" )
     return action_data
 
-def process_emails(auth_resp, request_data):
+def email_row_to_dict(email):
+    return {
+        'id': email[0],
+        'from': email[1],
+        'subject': email[2],
+        'message': email[3],
+        'date': email[4]
+    }
+
+def rules_match(email, rules):
+    if rules['predicate'] == 'All':
+        return all(apply_rule(email, rule) for rule in rules['rules'])
+    return any(apply_rule(email, rule) for rule in rules['rules'])
+
+def explain_rules(emails, rules, max_email_ids=DRY_RUN_MAX_EMAIL_IDS):
+    """Evaluate the rules against the stored emails without calling the Gmail API.
+
+    Returns the per-rule match counts, the planned label changes grouped by
+    operation and label, and the API calls / quota units a real run would use.
+    """
+    python_start = time.perf_counter()
+    rule_matches = [0] * len(rules['rules'])
+    matched_email_ids = []
+    for email in emails:
+        email_data = email_row_to_dict(email)
+        for index, rule in enumerate(rules['rules']):
+            if apply_rule(email_data, rule):
+                rule_matches[index] += 1
+        if rules_match(email_data, rules):
+            matched_email_ids.append(email_data['id'])
+    python_seconds = time.perf_counter() - python_start
+
+    # process_rules calls perform_actions once per rule for every matched email,
+    # and each call lists the labels before sending one modify per action
+    label_changes = {}
+    modify_calls = 0
+    for rule in rules['rules']:
+        for action in rule['actions']:
+            operation, label = ACTION_LABEL_CHANGES[action]
+            operation_changes = label_changes.setdefault(operation, {})
+            operation_changes[label] = operation_changes.get(label, 0) + len(matched_email_ids)
+            modify_calls += len(matched_email_ids)
+
+    api_calls = {
+        'users.getProfile': 1,
+        'users.labels.list': len(matched_email_ids) * len(rules['rules']),
+        'users.messages.modify': modify_calls
+    }
+    return {
+        'dry_run': True,
+        'emails_scanned': len(emails),
+        'candidates': len(emails),
+        'emails_matched': len(matched_email_ids),
+        'matched_email_ids': matched_email_ids[:max_email_ids],
+        'rule_matches': [
+            {'rule': index, 'actions': rule['actions'], 'matched': rule_matches[index]}
+            for index, rule in enumerate(rules['rules'])
+        ],
+        'label_changes': label_changes,
+        'api_calls': api_calls,
+        'total_api_calls': sum(api_calls.values()),
+        'quota_units': sum(QUOTA_UNITS[method] * count for method, count in api_calls.items()),
+        'timing': {'python_seconds': python_seconds}
+    }
+
+def rule_candidate_ids(user_id, rule):
+    """Ids of the emails that can match the rule, or None if the rule has no condition the search index can answer."""
+    candidate_ids = None
+    for condition in rule['conditions']:
+        # An equal value is also contained, so equals narrows the same way as contains
+        if condition['field'] not in SEARCH_COLUMNS or condition['predicate'] not in ('contains', 'equals'):
+            continue
+        if not isinstance(condition['value'], str) or len(condition['value']) < MIN_SEARCH_LENGTH:
+            continue
+        matched_ids = search_email_ids(user_id, condition['field'], condition['value'])
+        candidate_ids = matched_ids if candidate_ids is None else candidate_ids & matched_ids
+    return candidate_ids
+
+def indexed_candidate_ids(user_id, rules, per_rule=False):
+    rule_ids = [rule_candidate_ids(user_id, rule) for rule in rules['rules']]
+    # per_rule keeps every email any single rule can match, for the dry run's per rule counts
+    if rules['predicate'] == 'All' and not per_rule:
+        narrowed_ids = [ids for ids in rule_ids if ids is not None]
+        return set.intersection(*narrowed_ids) if narrowed_ids else None
+    if any(ids is None for ids in rule_ids):
+        return None
+    return set().union(*rule_ids)
+
+def fetch_candidate_emails(email_id, rules, per_rule=False):
+    """Fetch the stored emails that can match the rules, narrowed with the search index when it holds the stored content.
+
+    Every candidate is still checked with apply_rule, so the matches are the same as a full scan.
+    Returns the emails, whether the search index was used and the number of emails in the mailbox.
+    """
+    mailbox = fetch_mailbox_fingerprint(email_id)
+    # The index is only used when it holds exactly the stored content, a missing or stale
+    # row would hide a match, e.g. after a failed sync committed some chunks to MySQL.
+    # Both stores keep a count and fingerprint of the mailbox, so this is one row from each
+    if mailbox is not None and mailbox[1] and indexed_fingerprint(mailbox[0]) == (mailbox[1], mailbox[2]):
+        candidate_ids = indexed_candidate_ids(mailbox[0], rules, per_rule)
+        if candidate_ids is not None:
+            return fetch_emails_by_ids(email_id, candidate_ids), True, mailbox[1]
+    emails = fetch_emails_from_table(email_id)
+    return emails, False, len(emails)
+
+def single_flight(key, run):
+    """Run once for concurrent callers with the same key in this process, all of them get the leader's result.
+
+    Identical runs on other workers or hosts are shared through process_runs instead, see process_mailbox.
+    """
+    with in_flight_lock:
+        flight = in_flight_runs.get(key)
+        is_leader = flight is None
+        if is_leader:
+            flight = {'done': threading.Event(), 'result': None, 'waiters': 0}
+            in_flight_runs[key] = flight
+        else:
+            flight['waiters'] += 1
+    if not is_leader:
+        flight['done'].wait()
+        return flight['result']
     try:
-        service = build('gmail', 'v1', credentials=auth_resp)
-        email_id = service.users().getProfile(userId='me').execute()['emailAddress']
-        emails = fetch_emails_from_table(email_id)
+        flight['result'] = run()
+    finally:
+        with in_flight_lock:
+            del in_flight_runs[key]
+        flight['done'].set()
+    return flight['result']
+
+def process_mailbox(service, email_id, request_data):
+    rules_hash = hashlib.sha256(json.dumps(request_data, sort_keys=True).encode('utf-8')).hexdigest()
+    arrived_at = fetch_database_time()
+    # Different rule sets for the same mailbox queue on the lock instead of racing on the same emails
+    with mailbox_lock(email_id) as acquired:
+        if not acquired:
+            logging.error(f"Timed out waiting for another process run on mailbox: {email_id}")
+            return None
+        # An identical run on any worker finished while this one waited, its changes are already sent
+        shared_result = fetch_process_run_result(email_id, rules_hash, arrived_at)
+        if shared_result is not None:
+            logging.info(f"Sharing the result of an identical process run on mailbox: {email_id}")
+            return shared_result
+        emails, _, _ = fetch_candidate_emails(email_id, request_data)
         return_data = []
         for email in emails:
-            email_data = {
-                'id': email[0],
-                'from': email[1],
-                'subject': email[2],
-                'message': email[3],
-                'date': email[4]
-            }
-            process_response = process_rules(auth_resp, email_data, request_data)
+            email_data = email_row_to_dict(email)
+            process_response = process_rules(service, email_data, request_data)
             if process_response and len(process_response) > 0 :
                 return_data.append(process_response)
+        store_process_run_result(email_id, rules_hash, return_data)
         return return_data
+
+def process_emails(auth_resp, request_data, dry_run=False):
+    try:
+        service = build_gmail_service(auth_resp)
+        email_id = service.users().getProfile(userId='me').execute()['emailAddress']
+        if dry_run:
+            sql_start = time.perf_counter()
+            emails, used_search_index, email_count = fetch_candidate_emails(email_id, request_data, per_rule=True)
+            sql_seconds = time.perf_counter() - sql_start
+            explain_data = explain_rules(emails, request_data)
+            explain_data['timing']['sql_seconds'] = sql_seconds
+            explain_data['used_search_index'] = used_search_index
+            # The index narrows the emails that are checked, emails_scanned stays the mailbox size
+            explain_data['emails_scanned'] = email_count
+            return explain_data
+        # Identical rule sets already running for this mailbox share that run and its result
+        run_key = (email_id, json.dumps(request_data, sort_keys=True))
+        return single_flight(run_key, lambda: process_mailbox(service, email_id, request_data))
     except Exception:
         logging.error(f"Exception in process emails:  {traceback.format_exc()}")
         return None
@@ -201,7 +378,10 @@ def main():
         }
         return response
     request_data = json.loads(sys.argv[1])
-    return_data = process_emails(auth_resp,request_data)
+    dry_run = '--dry-run' in sys.argv[2:]
+    return_data = process_emails(auth_resp,request_data,dry_run)
+    if dry_run:
+        print(json.dumps(return_data, indent=4))
     return return_data
 
 if __name__ == '__main__':
@@ -0,0 +1,145 @@
+import os
+import hashlib
+import sqlite3
+import logging
+
+# SQLite FTS5 sidecar over the subject and body of the stored emails.
+# The trigram tokenizer answers substring lookups, which a word based index can not.
+# Relative paths are resolved against this directory, so the app and the CLI share one index
+# whatever directory they are started from
+SEARCH_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.getenv('SEARCH_INDEX_PATH', 'emails_fts.db'))
+
+# Trigram lookups need at least 3 characters
+MIN_SEARCH_LENGTH = 3
+
+# Rows per batch of index writes
+INDEX_CHUNK_SIZE = 500
+
+# Rule field to index column
+SEARCH_COLUMNS = {
+    'subject': 'subject',
+    'message': 'body'
+}
+
+def fingerprint_element(email_id, content_hash):
+    # 60 bits, so it fits both a signed SQLite INTEGER and the unsigned MySQL BIGINT
+    digest = hashlib.sha256(f'{email_id}\x1f{content_hash or ""}'.encode('utf-8')).hexdigest()
+    return int(digest[:15], 16)
+
+def fingerprint_changes(old_rows, new_rows):
+    """Per user [email count change, fingerprint xor] for writing new_rows over old_rows.
+
+    A mailbox fingerprint is the xor of fingerprint_element over its emails, MySQL and the
+    index both keep one per user up to date on every write, so comparing them is cheap.
+    old_rows maps id to (user_id, content_hash) of the stored rows, new_rows are
+    (id, user_id, content_hash) in write order.
+    """
+    old_rows = dict(old_rows)
+    changes = {}
+    for email_id, user_id, content_hash in new_rows:
+        if email_id in old_rows:
+            old_user_id, old_hash = old_rows[email_id]
+            change = changes.setdefault(old_user_id, [0, 0])
+            change[0] -= 1
+            change[1] ^= fingerprint_element(email_id, old_hash)
+        change = changes.setdefault(user_id, [0, 0])
+        change[0] += 1
+        change[1] ^= fingerprint_element(email_id, content_hash)
+        old_rows[email_id] = (user_id, content_hash)
+    return changes
+
+def connect_search_index():
+    conn = sqlite3.connect(SEARCH_INDEX_PATH, timeout=30)
+    conn.execute('''CREATE TABLE IF NOT EXISTS email_ids (
+                      rowid INTEGER PRIMARY KEY,
+                      id TEXT UNIQUE NOT NULL,
+                      user_id INTEGER,
+                      content_hash TEXT
+                    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS email_ids_user_id ON email_ids (user_id)')
+    conn.execute('''CREATE TABLE IF NOT EXISTS mailbox_fingerprints (
+                      user_id INTEGER PRIMARY KEY,
+                      email_count INTEGER NOT NULL,
+                      fingerprint INTEGER NOT NULL
+                    )''')
+    conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(
+                      subject, body, tokenize='trigram case_sensitive 1', detail=none
+                    )''')
+    return conn
+
+def index_emails(email_rows):
+    """Add or replace emails in the search index, store_emails calls this for the rows it wrote.
+
+    Takes (id, sender, subject, body, date, user_id, content_hash) rows, the format written to MySQL.
+    """
+    # The last row of an id wins, the same as the upserts into MySQL
+    email_rows = list({row[0]: row for row in email_rows}.values())
+    conn = connect_search_index()
+    with conn:
+        # Take the write lock before reading the rows being replaced, so concurrent writers
+        # can not apply their fingerprint changes to the same old rows
+        conn.execute('BEGIN IMMEDIATE')
+        for start in range(0, len(email_rows), INDEX_CHUNK_SIZE):
+            chunk = email_rows[start:start + INDEX_CHUNK_SIZE]
+            placeholders = ', '.join(['?'] * len(chunk))
+            old_rows = {row[0]: (row[1], row[2]) for row in conn.execute(
+                f'SELECT id, user_id, content_hash FROM email_ids WHERE id IN ({placeholders})', [row[0] for row in chunk])}
+            changes = fingerprint_changes(old_rows, [(row[0], row[5], row[6]) for row in chunk])
+            # SQLite has no xor operator, (a | b) & ~(a & b) is the same
+            conn.executemany('''INSERT INTO mailbox_fingerprints (user_id, email_count, fingerprint) VALUES (?, ?, ?)
+                                ON CONFLICT(user_id) DO UPDATE SET email_count = email_count + excluded.email_count,
+                                fingerprint = (fingerprint | excluded.fingerprint) & ~(fingerprint & excluded.fingerprint)''',
+                             [(user_id, change[0], change[1]) for user_id, change in changes.items()])
+            conn.executemany('''INSERT INTO email_ids (id, user_id, content_hash) VALUES (?, ?, ?)
+                                ON CONFLICT(id) DO UPDATE SET user_id = excluded.user_id, content_hash = excluded.content_hash''',
+                             [(row[0], row[5], row[6]) for row in chunk])
+            rowids = dict(conn.execute(f'SELECT id, rowid FROM email_ids WHERE id IN ({placeholders})',
+                                       [row[0] for row in chunk]))
+            conn.executemany('DELETE FROM emails_fts WHERE rowid = ?', [(rowids[row[0]],) for row in chunk])
+            conn.executemany('INSERT INTO emails_fts (rowid, subject, body) VALUES (?, ?, ?)',
+                             [(rowids[row[0]], row[2] or '', row[3] or '') for row in chunk])
+    conn.close()
+
+def invalidate_search_index():
+    """Drop the index when it could not be kept current, lookups fall back to a full scan until it is rebuilt."""
+    if os.path.exists(SEARCH_INDEX_PATH):
+        os.remove(SEARCH_INDEX_PATH)
+
+def indexed_fingerprint(user_id):
+    """(email count, fingerprint) of the user's indexed emails, or None if none were indexed."""
+    if not os.path.exists(SEARCH_INDEX_PATH):
+        return None
+    conn = connect_search_index()
+    row = conn.execute('SELECT email_count, fingerprint FROM mailbox_fingerprints WHERE user_id = ?', (user_id,)).fetchone()
+    conn.close()
+    return tuple(row) if row else None
+
+def search_email_ids(user_id, field, value):
+    """Ids of the user's emails whose field contains value, case sensitive like the Python substring check."""
+    # GLOB is case sensitive and the trigram index answers it, detail=none keeps the index small
+    # and fast to write as no token positions are stored. Escape the GLOB wildcards in the value.
+    pattern = '*%s*' % ''.join('[%s]' % char if char in '*?[' else char for char in value)
+    column = SEARCH_COLUMNS[field]
+    conn = connect_search_index()
+    # A join would run the lookup once per email of the user, the subquery runs it once
+    rows = conn.execute(f'''SELECT id FROM email_ids
+                            WHERE user_id = ? AND rowid IN (SELECT rowid FROM emails_fts WHERE {column} GLOB ?)''',
+                        (user_id, pattern)).fetchall()
+    conn.close()
+    return {row[0] for row in rows}
+
+def main():
+    # Imported here, base imports this module to keep the index current
+    from base import fetch_all_emails, refresh_mailbox_fingerprints
+    logging.basicConfig(level=logging.INFO)
+    invalidate_search_index()
+    count = 0
+    for email_rows in fetch_all_emails():
+        index_emails(email_rows)
+        count += len(email_rows)
+    # Recompute the MySQL side too, so the two fingerprints start from the same rows
+    refresh_mailbox_fingerprints()
+    logging.info(f"Rebuilt the search index with {count} emails")
+
+if __name__ == '__main__':
+    main()
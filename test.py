@@ -1,11 +1,21 @@
 import pytest
+import json
 import random
 import string
 import bcrypt
+import threading
+import time
 from unittest.mock import call
 from authorise import generate_password, hash_password, verify_password, verify_credentials
-from process_emails import is_valid_email,validate_rules,apply_rule
-from base import store_user, store_emails
+from process_emails import is_valid_email,validate_rules,apply_rule,explain_rules,single_flight,in_flight_runs,indexed_candidate_ids,rules_match,fetch_candidate_emails,process_mailbox
+from search_index import index_emails, search_email_ids, indexed_fingerprint, fingerprint_changes, fingerprint_element
+from gmail_service import load_discovery_document, build_gmail_service
+from base import store_user, store_emails, email_row, email_content_hash, escape_infile_value, mailbox_lock
+
+# Keep the search index written by store_emails out of the working directory
+@pytest.fixture(autouse=True)
+def search_index_path(tmp_path, monkeypatch):
+    monkeypatch.setattr('search_index.SEARCH_INDEX_PATH', str(tmp_path / 'emails_fts.db'))
 
 # Mock for fetch_user function used in verify_credentials
 @pytest.fixture
@@ -152,6 +162,35 @@ def test_apply_rule():
     }
     assert not apply_rule(email, rule)
 
+def test_explain_rules():
+    emails = [
+        ('1', 'test@example.com', 'Hello', 'This is a test', 1609459200000),
+        ('2', 'other@example.com', 'Hello again', 'Another test', 1609459200000)
+    ]
+    rules = {
+        "predicate": "All",
+        "rules": [
+            {
+                "conditions": [
+                    {"field": "from", "predicate": "equals", "value": "test@example.com"}
+                ],
+                "actions": ["mark_as_read", "move_message"]
+            }
+        ]
+    }
+    result = explain_rules(emails, rules)
+
+    assert result['emails_scanned'] == 2
+    assert result['candidates'] == 2
+    assert result['emails_matched'] == 1
+    assert result['rule_matches'][0]['matched'] == 1
+    assert result['matched_email_ids'] == ['1']
+    assert result['label_changes'] == {'removeLabelIds': {'UNREAD': 1}, 'addLabelIds': {'<random user label>': 1}}
+    assert result['api_calls'] == {'users.getProfile': 1, 'users.labels.list': 1, 'users.messages.modify': 2}
+    assert result['total_api_calls'] == 4
+    assert result['quota_units'] == 12
+    assert explain_rules(emails, rules, max_email_ids=0)['matched_email_ids'] == []
+
 def test_store_user(mocker):
     # Mock database connection and cursor
     mock_conn = mocker.patch('mysql.connector.connect')
@@ -216,13 +255,13 @@ def test_store_emails(mocker):
     
     # Assert database interaction
     insert_query = '''
-    INSERT INTO emails (id, sender, subject, body, date, user_id) 
-    VALUES (%s, %s, %s, %s, %s, %s)
-    ON DUPLICATE KEY UPDATE sender = VALUES(sender), subject = VALUES(subject), body = VALUES(body), date = VALUES(date), user_id = VALUES(user_id) '''
+    INSERT INTO emails (id, sender, subject, body, date, user_id, content_hash) 
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE sender = VALUES(sender), subject = VALUES(subject), body = VALUES(body), date = VALUES(date), user_id = VALUES(user_id), content_hash = VALUES(content_hash) '''
 
     email_values = [
         (
-            email['id'], email['from'], email['subject'], email['body'], email['date'], email['user_id']
+            email['id'], email['from'], email['subject'], email['body'], email['date'], email['user_id'], email_content_hash(email)
         ) for email in email_data
     ]
 
@@ -245,6 +284,307 @@ def test_store_emails(mocker):
     # Assert return value
     assert result == {"status": True}
 
+def test_store_emails_bulk(mocker):
+    mock_conn = mocker.patch('mysql.connector.connect')
+    mock_cursor = mock_conn.return_value.cursor.return_value
+
+    email_data = [
+        {'id': '1', 'from': 'sender@example.com', 'subject': 'Test Subject', 'body': 'Test Body', 'date': 1234567890, 'user_id': 1},
+        {'id': '2', 'from': 'another@example.com', 'subject': 'Another Subject', 'body': 'Another Body', 'date': 987654321, 'user_id': 1},
+        {'id': '3', 'from': 'third@example.com', 'subject': 'Third Subject', 'body': 'Third Body', 'date': 987654322, 'user_id': 1}
+    ]
+    # Email 1 is unchanged, email 2 has a stale hash and email 3 is new
+    mock_cursor.fetchall.return_value = [('1', 1, email_content_hash(email_data[0])), ('2', 1, 'stale')]
+
+    result = store_emails(email_data, mode='bulk', chunk_size=2, commit_size=1)
+
+    assert result == {"status": True, "stored": 2, "skipped": 1}
+    insert_calls = [c for c in mock_cursor.execute.call_args_list if c[0][0].strip().startswith('INSERT')]
+    assert len(insert_calls) == 2
+    assert insert_calls[0][0][1][0] == '2'
+    assert insert_calls[1][0][1][0] == '3'
+    assert mock_conn.return_value.commit.call_count == 3
+    # The mailbox fingerprint swaps the stale row of email 2 for the new one and adds email 3
+    fingerprint_calls = [c[0][1] for c in mock_cursor.executemany.call_args_list if 'mailbox_fingerprints' in c[0][0]]
+    assert fingerprint_calls == [
+        [(1, 0, fingerprint_element('2', 'stale') ^ fingerprint_element('2', email_content_hash(email_data[1])))],
+        [(1, 1, fingerprint_element('3', email_content_hash(email_data[2])))]
+    ]
+    # Only the rows written to MySQL are indexed
+    assert search_email_ids(1, 'subject', 'Subject') == {'2', '3'}
+
+def test_store_emails_without_index(mocker):
+    mock_conn = mocker.patch('mysql.connector.connect')
+    mock_conn.return_value.cursor.return_value.fetchall.return_value = []
+    mock_index = mocker.patch('base.index_emails')
+    email_data = [{'id': '1', 'from': 'a@example.com', 'subject': 'Subject', 'body': 'Body', 'date': 1, 'user_id': 1}]
+
+    # Backfills skip the index and rebuild it once afterwards
+    assert store_emails(email_data, mode='bulk', index=False) == {"status": True, "stored": 1, "skipped": 0}
+    assert mock_index.call_count == 0
+    store_emails(email_data, mode='bulk')
+    assert mock_index.call_count == 1
+
+def test_store_emails_invalid_mode():
+    assert store_emails([], mode='invalid')["status"] is False
+
+def test_store_emails_load_data(mocker):
+    mock_conn = mocker.patch('mysql.connector.connect')
+    mock_cursor = mock_conn.return_value.cursor.return_value
+    email_data = [
+        {'id': '1', 'from': 'sender@example.com', 'subject': 'Test Subject', 'body': 'Test Body', 'date': 1234567890, 'user_id': 1},
+        {'id': '2', 'from': 'another@example.com', 'subject': 'Another Subject', 'body': 'Another\tBody', 'date': 987654321, 'user_id': 1},
+        {'id': '3', 'from': 'third@example.com', 'subject': 'Third Subject', 'body': 'Third Body', 'date': 987654322, 'user_id': 1}
+    ]
+    infile_contents = []
+
+    def execute(query, params=None):
+        # The infile is removed once the call returns, so read it while LOAD DATA runs
+        if 'LOAD DATA' in query:
+            with open(params[0], encoding='utf-8') as infile:
+                infile_contents.append(infile.read())
+    mock_cursor.execute.side_effect = execute
+    # Email 1 is unchanged, so only 2 and 3 come back from the changed row select
+    mock_cursor.fetchall.return_value = [
+        ('2', 1, email_content_hash(email_data[1]), '2', 1, 'stale'),
+        ('3', 1, email_content_hash(email_data[2]), None, None, None)
+    ]
+
+    result = store_emails(email_data, mode='load_data')
+
+    assert result == {"status": True, "stored": 2, "skipped": 1}
+    queries = [normalize_sql(c[0][0]) for c in mock_cursor.execute.call_args_list]
+    assert queries[0] == 'CREATE TEMPORARY TABLE emails_staging LIKE emails'
+    assert queries[1].startswith('LOAD DATA LOCAL INFILE %s INTO TABLE emails_staging')
+    assert queries[2].startswith('SELECT emails_staging.id, emails_staging.user_id, emails_staging.content_hash, emails.id')
+    assert 'emails.content_hash <> emails_staging.content_hash' in queries[2]
+    assert queries[2].endswith('FOR UPDATE')
+    assert queries[3].startswith('INSERT INTO emails (id, sender, subject, body, date, user_id, content_hash) SELECT * FROM')
+    assert 'ON DUPLICATE KEY UPDATE' in queries[3]
+    assert queries[4] == 'DROP TEMPORARY TABLE IF EXISTS emails_staging'
+    assert mock_cursor.executemany.call_args[0][1] == [
+        (1, 1, fingerprint_element('2', 'stale') ^ fingerprint_element('2', email_content_hash(email_data[1]))
+               ^ fingerprint_element('3', email_content_hash(email_data[2])))
+    ]
+    assert mock_conn.return_value.commit.call_count == 1
+    assert mock_conn.return_value.close.call_count == 1
+    assert infile_contents[0].splitlines()[1].split('\t')[3] == 'Another\\tBody'
+    # Only the rows written are indexed
+    assert search_email_ids(1, 'subject', 'Subject') == {'2', '3'}
+
+def test_store_emails_load_data_error(mocker):
+    mock_conn = mocker.patch('mysql.connector.connect')
+    mock_cursor = mock_conn.return_value.cursor.return_value
+
+    def execute(query, params=None):
+        if 'LOAD DATA' in query:
+            raise Exception('local_infile disabled')
+    mock_cursor.execute.side_effect = execute
+
+    result = store_emails([{'id': '1', 'from': 'a@example.com', 'subject': 's', 'body': 'b', 'date': 1, 'user_id': 1}], mode='load_data')
+
+    assert result["status"] is False
+    assert normalize_sql(mock_cursor.execute.call_args_list[-1][0][0]) == 'DROP TEMPORARY TABLE IF EXISTS emails_staging'
+    assert mock_conn.return_value.close.call_count == 1
+
+def test_escape_infile_value():
+    assert escape_infile_value(None) == '\\N'
+    assert escape_infile_value('a\tb\nc\\d') == 'a\\tb\\nc\\\\d'
+    assert escape_infile_value(12) == '12'
+
+def test_build_gmail_service():
+    from google.auth.credentials import AnonymousCredentials
+    assert load_discovery_document() is load_discovery_document()
+    assert load_discovery_document()['version'] == 'v1'
+    discovery_document = json.dumps(load_discovery_document(), sort_keys=True)
+    service = build_gmail_service(AnonymousCredentials())
+    request = service.users().getProfile(userId='me')
+    service.users().messages().modify(userId='me', id='1', body={})
+    # The cached document is left as it was loaded
+    assert json.dumps(load_discovery_document(), sort_keys=True) == discovery_document
+    assert request.uri == 'https://gmail.googleapis.com/gmail/v1/users/me/profile?alt=json'
+
+def test_single_flight():
+    key = ('user@example.com', 'rules')
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def run():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return ['processed']
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(single_flight(key, run))) for _ in range(3)]
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    # Release the leader only once both followers are waiting on its run
+    deadline = time.monotonic() + 5
+    while in_flight_runs[key]['waiters'] < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert in_flight_runs[key]['waiters'] == 2
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [['processed']] * 3
+    # Once the run is finished the next call runs again
+    assert single_flight(key, run) == ['processed']
+    assert len(calls) == 2
+
+def test_process_mailbox(mocker):
+    rules = {
+        "predicate": "All",
+        "rules": [{
+            "conditions": [{"field": "subject", "predicate": "contains", "value": "Hello"}],
+            "actions": ["mark_as_read"]
+        }]
+    }
+    mock_lock = mocker.patch('process_emails.mailbox_lock')
+    mock_lock.return_value.__enter__.return_value = True
+    mocker.patch('process_emails.fetch_database_time', return_value='arrived')
+    mock_shared = mocker.patch('process_emails.fetch_process_run_result')
+    mock_store = mocker.patch('process_emails.store_process_run_result')
+    mocker.patch('process_emails.fetch_candidate_emails',
+                 return_value=([('1', 'test@example.com', 'Hello', 'body', 1609459200000)], False, 1))
+    mock_perform = mocker.patch('process_emails.perform_actions', return_value={'email_id': '1', 'moved_action': ['READ']})
+
+    # An identical run on another worker finished while this one waited for the lock
+    mock_shared.return_value = [[{'email_id': '1', 'moved_action': ['READ']}]]
+    assert process_mailbox(None, 'user@example.com', rules) == [[{'email_id': '1', 'moved_action': ['READ']}]]
+    rules_hash = mock_shared.call_args[0][1]
+    assert mock_shared.call_args == call('user@example.com', rules_hash, 'arrived')
+    assert mock_perform.call_count == 0
+    assert mock_store.call_count == 0
+
+    mock_shared.return_value = None
+    assert process_mailbox(None, 'user@example.com', rules) == [[{'email_id': '1', 'moved_action': ['READ']}]]
+    assert mock_perform.call_count == 1
+    assert mock_store.call_args == call('user@example.com', rules_hash, [[{'email_id': '1', 'moved_action': ['READ']}]])
+
+def test_mailbox_lock(mocker):
+    mock_conn = mocker.patch('mysql.connector.connect')
+    mock_cursor = mock_conn.return_value.cursor.return_value
+    mock_cursor.fetchone.return_value = (1,)
+
+    with mailbox_lock('user@example.com', timeout=10) as acquired:
+        assert acquired
+    lock_name = mock_cursor.execute.call_args_list[0][0][1][0]
+    assert mock_cursor.execute.call_args_list[0] == call('SELECT GET_LOCK(%s, %s)', (lock_name, 10))
+    assert mock_cursor.execute.call_args_list[1] == call('SELECT RELEASE_LOCK(%s)', (lock_name,))
+    assert len(lock_name) <= 64
+
+    mock_cursor.reset_mock()
+    mock_cursor.fetchone.return_value = (0,)
+    with mailbox_lock('user@example.com', timeout=10) as acquired:
+        assert not acquired
+    assert mock_cursor.execute.call_count == 1
+
+    # The connection is closed when GET_LOCK itself fails
+    mock_conn.return_value.close.reset_mock()
+    mock_cursor.execute.side_effect = Exception('Lost connection')
+    with pytest.raises(Exception):
+        with mailbox_lock('user@example.com', timeout=10):
+            pass
+    assert mock_conn.return_value.close.call_count == 1
+
+def test_search_index():
+    email_data = [
+        {'id': '1', 'from': 'a@example.com', 'subject': 'Unlivable city', 'body': 'Security alert for "you"', 'date': 1, 'user_id': 1},
+        {'id': '2', 'from': 'b@example.com', 'subject': 'Livable city', 'body': 'security newsletter', 'date': 2, 'user_id': 1},
+        {'id': '3', 'from': 'c@example.com', 'subject': 'livable city', 'body': 'Security alert', 'date': 3, 'user_id': 2}
+    ]
+    index_emails([email_row(email) for email in email_data])
+    # Re-indexing an email replaces it
+    email_data[1]['subject'] = 'Lovely city'
+    index_emails([email_row(email_data[1])])
+
+    # The fingerprints kept up to date on write are the ones computed from the indexed rows
+    for user_id in (1, 2):
+        rows = [(email['id'], email['user_id'], email_content_hash(email)) for email in email_data if email['user_id'] == user_id]
+        assert indexed_fingerprint(user_id) == tuple(fingerprint_changes({}, rows)[user_id])
+    assert indexed_fingerprint(1)[0] == 2
+    assert indexed_fingerprint(3) is None
+    assert search_email_ids(1, 'subject', 'livable') == {'1'}
+    assert search_email_ids(1, 'subject', 'Livable') == set()
+    assert search_email_ids(1, 'message', 'Security') == {'1'}
+    assert search_email_ids(1, 'message', 'for "you"') == {'1'}
+    assert search_email_ids(1, 'message', 'alert*') == set()
+    assert search_email_ids(2, 'subject', 'livable') == {'3'}
+
+def test_indexed_candidate_ids():
+    email_data = [
+        {'id': str(index), 'from': 'a@example.com', 'subject': subject, 'body': body, 'date': 1, 'user_id': 1}
+        for index, (subject, body) in enumerate([
+            ('Unlivable city', 'Security alert'), ('Livable city', 'Security alert'),
+            ('livable', 'nothing'), ('other', 'security'), ('ab', 'Security')
+        ])
+    ]
+    index_emails([email_row(email) for email in email_data])
+    emails = {email['id']: {'id': email['id'], 'from': email['from'], 'subject': email['subject'], 'message': email['body'], 'date': 1} for email in email_data}
+
+    rules = {
+        "predicate": "All",
+        "rules": [{
+            "conditions": [
+                {"field": "subject", "predicate": "contains", "value": "livable"},
+                {"field": "message", "predicate": "contains", "value": "Security"}
+            ],
+            "actions": ["mark_as_read"]
+        }]
+    }
+    candidate_ids = indexed_candidate_ids(1, rules)
+    assert candidate_ids == {'0'}
+    # The index narrows without dropping any email the full scan matches
+    assert {email_id for email_id, email in emails.items() if rules_match(email, rules)} <= candidate_ids
+
+    rules["rules"][0]["conditions"] = [{"field": "subject", "predicate": "does_not_contain", "value": "livable"}]
+    assert indexed_candidate_ids(1, rules) is None
+    rules["rules"][0]["conditions"] = [{"field": "subject", "predicate": "contains", "value": "ab"}]
+    assert indexed_candidate_ids(1, rules) is None
+
+def test_fetch_candidate_emails(mocker):
+    email_data = [
+        {'id': '1', 'from': 'a@example.com', 'subject': 'Unlivable city', 'body': 'Security alert', 'date': 1, 'user_id': 1},
+        {'id': '2', 'from': 'b@example.com', 'subject': 'Other', 'body': 'newsletter', 'date': 2, 'user_id': 1}
+    ]
+    index_emails([email_row(email) for email in email_data])
+    email_count, fingerprint = fingerprint_changes({}, [(email['id'], 1, email_content_hash(email)) for email in email_data])[1]
+    mock_fingerprint = mocker.patch('process_emails.fetch_mailbox_fingerprint')
+    mock_by_ids = mocker.patch('process_emails.fetch_emails_by_ids', return_value=['candidate rows'])
+    mock_all = mocker.patch('process_emails.fetch_emails_from_table', return_value=['all rows'])
+    rules = {
+        "predicate": "All",
+        "rules": [{
+            "conditions": [{"field": "subject", "predicate": "contains", "value": "livable"}],
+            "actions": ["mark_as_read"]
+        }]
+    }
+
+    mock_fingerprint.return_value = (1, email_count, fingerprint)
+    assert fetch_candidate_emails('user@example.com', rules) == (['candidate rows'], True, 2)
+    assert mock_by_ids.call_args == call('user@example.com', {'1'})
+
+    # An email stored in MySQL but missing from the index
+    mock_fingerprint.return_value = (1, email_count + 1, fingerprint ^ fingerprint_element('3', 'hash'))
+    assert fetch_candidate_emails('user@example.com', rules) == (['all rows'], False, 1)
+
+    # An email whose content changed in MySQL but not in the index, with the same count
+    changed = fingerprint ^ fingerprint_element('2', email_content_hash(email_data[1])) ^ fingerprint_element('2', 'changed')
+    mock_fingerprint.return_value = (1, email_count, changed)
+    assert fetch_candidate_emails('user@example.com', rules) == (['all rows'], False, 1)
+
+    # A user with no stored emails
+    mock_fingerprint.return_value = (1, None, None)
+    assert fetch_candidate_emails('user@example.com', rules) == (['all rows'], False, 1)
+    assert mock_by_ids.call_count == 1
+    assert mock_all.call_count == 3
+
 def normalize_sql(sql):
     """Remove extra spaces and newlines from the SQL query for comparison."""
     return ' '.join(sql.split())
\ No newline at end of file